@@ -2,7 +2,7 @@
 # /// script
 # requires-python = ">=3.8"
 # dependencies = [
-#     "pycryptodome",
+#     "cryptography",
 # ]
 # ///
 """
@@ -22,10 +22,10 @@ import sqlite3
 import subprocess
 import hashlib
 import json
-import tempfile
-import shutil
-from Crypto.Cipher import AES
-from Crypto.Protocol.KDF import PBKDF2
+import pathlib
+import stat
+import functools
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 
 # Chrome encryption parameters
 SALT = b"saltysalt"
@@ -33,6 +33,16 @@ IV = b" " * 16  # 16 spaces
 LENGTH = 16
 ITERATIONS = 1003
 
+# Chrome samesite column value -> Playwright sameSite. Chrome stores -1 for
+# an unspecified SameSite attribute and treats it as Lax.
+SAME_SITE = ("None", "Lax", "Strict")
+
+
+@functools.lru_cache(maxsize=None)
+def _host_digest(host_key):
+    """SHA-256 of a host_key, shared by all cookies for that host."""
+    return hashlib.sha256(host_key.encode()).digest()
+
 
 class Cookie:
     def __init__(self, name, value, domain, path, encrypted_value, expires_utc, 
@@ -48,69 +58,81 @@ class Cookie:
         self.same_site = same_site
         self.host_key = host_key
     
-    def decrypted(self, password):
-        if self.value:
-            return self.value
+    @property
+    def needs_decryption(self):
+        """Whether the value has to go through AES; Chrome prefixes encrypted
+        values with 'v10' or 'v11'."""
+        return not self.value and bool(self.encrypted) and self.encrypted[:3] in (b'v10', b'v11')
+    
+    def decrypted(self, cipher):
+        if not self.needs_decryption:
+            if self.value:
+                return self.value
+            if not self.encrypted:
+                return ""
+            # Not v10/v11 encrypted, return as is
+            return self.encrypted.decode('utf-8', errors='ignore')
         
-        if self.encrypted and len(self.encrypted) > 0:
-            # Chrome prefixes encrypted values with 'v10' or 'v11'
-            if self.encrypted[:3] in [b'v10', b'v11']:
-                encrypted_value = self.encrypted[3:]
-                
-                # Decrypt using AES-CBC
-                key = PBKDF2(password.encode(), SALT, dkLen=LENGTH, count=ITERATIONS)
-                cipher = AES.new(key, AES.MODE_CBC, IV)
-                decrypted = cipher.decrypt(encrypted_value)
-                
-                # Remove PKCS7 padding
-                try:
-                    plaintext = self._unpad(decrypted)
-                except:
-                    plaintext = decrypted
-                
-                # There's a SHA-256 hash of the domain value prepended to the encrypted value
-                # after https://crrev.com/c/5792044.
-                if len(plaintext) >= 32:
-                    hash_value = plaintext[:32]
-                    computed = hashlib.sha256(self.host_key.encode()).digest()
-                    
-                    if hash_value == computed:
-                        return plaintext[32:].decode('utf-8', errors='ignore')
-                    else:
-                        # Try without domain hash (older format)
-                        return plaintext.decode('utf-8', errors='ignore')
-                else:
-                    return plaintext.decode('utf-8', errors='ignore')
-            else:
-                # Not v10/v11 encrypted, return as is
-                return self.encrypted.decode('utf-8', errors='ignore')
+        # Decrypt using AES-CBC
+        decryptor = cipher.decryptor()
+        decrypted = decryptor.update(self.encrypted[3:]) + decryptor.finalize()
+        
+        # Remove PKCS7 padding
+        try:
+            plaintext = self._unpad(decrypted)
+        except:
+            plaintext = decrypted
+        
+        # There's a SHA-256 hash of the domain value prepended to the encrypted value
+        # after https://crrev.com/c/5792044.
+        if len(plaintext) >= 32 and plaintext[:32] == _host_digest(self.host_key):
+            return plaintext[32:].decode('utf-8', errors='ignore')
         
-        return ""
+        # Older format without the domain hash
+        return plaintext.decode('utf-8', errors='ignore')
     
     def _unpad(self, data):
         """Remove PKCS7 padding"""
         padding = data[-1]
-        if padding > 16:
+        # Validate padding: every padding byte must equal the padding length
+        if not 1 <= padding <= 16 or data[-padding:] != bytes([padding]) * padding:
             raise ValueError('Invalid padding')
-        # Validate padding
-        for i in range(1, padding + 1):
-            if data[-i] != padding:
-                raise ValueError('Invalid padding')
         return data[:-padding]
 
 
-def get_password():
-    """Get Chrome Safe Storage password from macOS Keychain."""
+def request_password():
+    """Start reading the Chrome Safe Storage password from macOS Keychain."""
     import platform
     if platform.system() != "Darwin":
         raise NotImplementedError("This script currently only supports macOS")
     
-    try:
-        cmd = ["/usr/bin/security", "find-generic-password", "-wga", "Chrome"]
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-        return result.stdout.strip()
-    except subprocess.CalledProcessError as e:
-        raise Exception(f"Failed to get password from keychain: {e.stderr}")
+    cmd = ["/usr/bin/security", "find-generic-password", "-wga", "Chrome"]
+    return subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+
+
+def get_password(proc):
+    """Wait for the Keychain lookup started by request_password()."""
+    stdout, stderr = proc.communicate()
+    if proc.returncode:
+        raise Exception(f"Failed to get password from keychain: {stderr}")
+    return stdout.strip()
+
+
+def derive_key(password):
+    """Derive the AES key from the Chrome Safe Storage password."""
+    return hashlib.pbkdf2_hmac('sha1', password.encode(), SALT, ITERATIONS, dklen=LENGTH)
+
+
+def _read_cookies(cursor, query, params, domain):
+    """Run the cookie query and build a Cookie for each row."""
+    cursor.execute(query, params)
+    
+    cookies = []
+    for row in cursor:
+        name, value, host_key, path, encrypted_value, expires_utc, is_secure, is_httponly, same_site = row
+        cookies.append(Cookie(name, value, domain, path, encrypted_value, 
+                            expires_utc, is_secure, is_httponly, same_site, host_key))
+    return cookies
 
 
 def get_cookies(domain, profile_name="Default"):
@@ -118,74 +140,62 @@ def get_cookies(domain, profile_name="Default"):
     home = os.path.expanduser("~")
     cookies_file = os.path.join(home, "Library", "Application Support", "Google", "Chrome", profile_name, "Cookies")
     
-    if not os.path.exists(cookies_file):
-        raise FileNotFoundError(f"Cookie file not found: {cookies_file}")
+    # Open the live database read-only and immutable so Chrome's lock is not
+    # an issue and no copy of the (often multi-MB) file is needed
+    try:
+        conn = sqlite3.connect(f"{pathlib.Path(cookies_file).as_uri()}?mode=ro&immutable=1", uri=True)
+    except sqlite3.OperationalError as e:
+        # SQLite reports a missing file and a denied one (permissions, macOS
+        # privacy controls) the same way; only stat on this failure path
+        if os.path.exists(cookies_file):
+            raise PermissionError(f"Cannot open cookie file: {cookies_file} ({e})") from e
+        raise FileNotFoundError(f"Cookie file not found: {cookies_file} ({e})") from e
+    # immutable=1 already skips journal and lock handling; these keep the
+    # connection strictly read-only and any temp b-trees (IN list) in memory
+    conn.execute("PRAGMA query_only = ON")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    cursor = conn.cursor()
+    
+    # Build list of domains to query
+    domains_to_query = []
+    
+    # Always include the exact domain
+    domains_to_query.append(domain)
+    
+    # Also include with leading dot
+    if not domain.startswith('.'):
+        domains_to_query.append('.' + domain)
+    
+    # If it's a subdomain, also include parent domains
+    if '.' in domain and not domain.startswith('.'):
+        # For example: console.anthropic.com -> also check .anthropic.com
+        parent = domain
+        while '.' in parent:
+            parent = parent[parent.index('.'):]
+            domains_to_query.append(parent)
+            parent = parent[1:]
     
-    # Create a copy of the cookies file to avoid database lock issues
-    with tempfile.NamedTemporaryFile(delete=False) as tmp:
-        tmp_path = tmp.name
+    # Build IN clause placeholders for all domains
+    placeholders = ','.join('?' * len(domains_to_query))
     
+    # Query for cookies
+    query = f"""
+        SELECT name, value, host_key, path, encrypted_value, 
+               expires_utc, is_secure, is_httponly, samesite
+        FROM cookies 
+        WHERE host_key IN ({placeholders})
+    """
     try:
-        shutil.copy2(cookies_file, tmp_path)
-        
-        conn = sqlite3.connect(tmp_path)
-        cursor = conn.cursor()
-        
-        # Build list of domains to query
-        domains_to_query = []
-        
-        # Always include the exact domain
-        domains_to_query.append(domain)
-        
-        # Also include with leading dot
-        if not domain.startswith('.'):
-            domains_to_query.append('.' + domain)
-        
-        # If it's a subdomain, also include parent domains
-        if '.' in domain and not domain.startswith('.'):
-            parts = domain.split('.')
-            # For example: console.anthropic.com -> also check .anthropic.com
-            for i in range(1, len(parts)):
-                parent = '.' + '.'.join(parts[i:])
-                domains_to_query.append(parent)
-        
-        # Build WHERE clause for all domains
-        where_conditions = ' OR '.join(['host_key = ?' for _ in domains_to_query])
-        
-        # Set text factory to bytes to handle binary data
-        conn.text_factory = bytes
-        
-        # Query for cookies
-        query = f"""
-            SELECT name, value, host_key, path, encrypted_value, 
-                   expires_utc, is_secure, is_httponly, samesite
-            FROM cookies 
-            WHERE {where_conditions}
-        """
-        cursor.execute(query, domains_to_query)
-        
-        cookies = []
-        for row in cursor.fetchall():
-            name, value, host_key, path, encrypted_value, expires_utc, is_secure, is_httponly, same_site = row
-            # Decode text fields that are bytes
-            if isinstance(name, bytes):
-                name = name.decode('utf-8', errors='ignore')
-            if isinstance(value, bytes):
-                value = value.decode('utf-8', errors='ignore')
-            if isinstance(host_key, bytes):
-                host_key = host_key.decode('utf-8', errors='ignore')
-            if isinstance(path, bytes):
-                path = path.decode('utf-8', errors='ignore')
-            cookies.append(Cookie(name, value, domain, path, encrypted_value, 
-                                expires_utc, is_secure, is_httponly, same_site, host_key))
-        
-        conn.close()
-        return cookies, domains_to_query
+        cookies = _read_cookies(cursor, query, domains_to_query, domain)
+    except sqlite3.OperationalError:
+        # The default text factory fails on a TEXT column that is not valid
+        # UTF-8; re-run once decoding leniently. BLOB columns
+        # (encrypted_value) are not affected and stay bytes.
+        conn.text_factory = lambda b: b.decode('utf-8', errors='ignore')
+        cookies = _read_cookies(conn.cursor(), query, domains_to_query, domain)
     
-    finally:
-        # Clean up temporary file
-        if os.path.exists(tmp_path):
-            os.unlink(tmp_path)
+    conn.close()
+    return cookies, domains_to_query
 
 
 def main():
@@ -205,28 +215,43 @@ def main():
     os.makedirs(cookies_dir, exist_ok=True)
     
     try:
-        # Get Chrome Safe Storage password
-        password = get_password()
-        
-        # Get cookies
-        cookies, domains_queried = get_cookies(domain, profile)
-        
-        if not cookies:
-            print(f"Error: No cookies found for domain: {domain}", file=sys.stderr)
-            print(f"Make sure you are logged into https://{domain} in Chrome", file=sys.stderr)
-            sys.exit(1)
-        
-        # Read existing storage file
+        # Start the Chrome Safe Storage password lookup; it runs while the
+        # cookie database is read
+        password_proc = request_password()
         try:
-            with open(storage_file, 'r') as f:
-                storage_state = json.load(f)
-        except:
-            storage_state = {"cookies": [], "origins": []}
+            # Get cookies
+            cookies, domains_queried = get_cookies(domain, profile)
+            
+            if not cookies:
+                print(f"Error: No cookies found for domain: {domain}", file=sys.stderr)
+                print(f"Make sure you are logged into https://{domain} in Chrome", file=sys.stderr)
+                sys.exit(1)
+            
+            # Read existing storage file
+            try:
+                with open(storage_file, 'r') as f:
+                    storage_state = json.load(f)
+            except:
+                storage_state = {"cookies": [], "origins": []}
+            
+            # Derive the decryption key and set up the cipher once; they are the
+            # same for every cookie, only the per-cookie decryptor context differs.
+            # Skip the key derivation entirely when nothing is encrypted.
+            cipher = None
+            if any(cookie.needs_decryption for cookie in cookies):
+                password = get_password(password_proc)
+                cipher = Cipher(algorithms.AES(derive_key(password)), modes.CBC(IV))
+        finally:
+            # Stop the Keychain lookup if it was not needed or we bailed out
+            # (including Ctrl-C), then reap it and close its pipes
+            if password_proc.returncode is None:
+                password_proc.kill()
+                password_proc.communicate()
         
         # Convert cookies to Playwright format
         new_cookies = []
         for cookie in cookies:
-            decrypted_value = cookie.decrypted(password)
+            decrypted_value = cookie.decrypted(cipher)
             if decrypted_value:
                 # __Host- prefixed cookies require specific domain (no leading dot)
                 if cookie.name.startswith("__Host-"):
@@ -241,7 +266,7 @@ def main():
                     "path": cookie.path,
                     "httpOnly": bool(cookie.is_httponly),
                     "secure": bool(cookie.is_secure),
-                    "sameSite": ["None", "Lax", "Strict"][cookie.same_site] if cookie.same_site < 3 else "None"
+                    "sameSite": SAME_SITE[cookie.same_site] if 0 <= cookie.same_site < 3 else "Lax"
                 }
                 
                 # Only add expires if it's a persistent cookie (not a session cookie)
@@ -251,16 +276,33 @@ def main():
         
         # Update storage state with new cookies (replacing existing ones for this domain)
         # Remove old cookies for these domains
+        domain_tails = tuple(d.lstrip('.') for d in domains_queried)
         storage_state["cookies"] = [
             c for c in storage_state["cookies"] 
-            if not any(c["domain"].endswith(d.lstrip('.')) for d in domains_queried)
+            if not c["domain"].endswith(domain_tails)
         ]
         # Add new cookies
         storage_state["cookies"].extend(new_cookies)
         
-        # Save updated storage state
-        with open(storage_file, 'w') as f:
-            json.dump(storage_state, f, indent=2)
+        # Save updated storage state atomically so a crash mid-write cannot
+        # leave a truncated storage.json behind. The temp file is created 0600
+        # under a fixed name, so a leftover one is simply overwritten next run;
+        # an existing storage.json keeps its own permissions.
+        tmp_file = storage_file + '.tmp'
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                # O_CREAT's mode does not apply to a leftover temp file
+                os.fchmod(f.fileno(), 0o600)
+                json.dump(storage_state, f, indent=2)
+            try:
+                os.chmod(tmp_file, stat.S_IMODE(os.stat(storage_file).st_mode))
+            except FileNotFoundError:
+                pass
+            os.replace(tmp_file, storage_file)
+        except BaseException:
+            os.unlink(tmp_file)
+            raise
         
         print(f"✓ Extracted {len(new_cookies)} cookies for {domain}")
         print(f"✓ Updated storage.json")